@@ -1,21 +1,135 @@
 import os
 import re
+import struct
 import asyncio
 import aiohttp
-import requests
-import multiprocess as mp
+import img2pdf
+import lxml.html
 
-from shutil import rmtree
 from slugify import slugify
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from PIL import Image, ImageFile
+from io import BytesIO
 from collections import OrderedDict
-from aiofiles import open as aio_open
 from PIL import Image, UnidentifiedImageError
 from concurrent.futures import ThreadPoolExecutor
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+_NUM_RE = re.compile(r"\d+")
+# Lets image XPath expressions match classes with EXSLT regular expressions
+_XPATH_NS = {"re": "http://exslt.org/regular-expressions"}
+# Strips whitespace from image URLs without going through the regex engine
+_WS_TABLE = str.maketrans("", "", " \t\r\n\f\v")
+
+# Number of concurrent image downloads per chapter
+IMAGE_WORKERS = 16
+# Threads used to encode chapter PDFs off the event loop
+PDF_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+# Size PDF pages at 100 DPI
+_PDF_LAYOUT = img2pdf.get_fixed_dpi_layout_fun((100, 100))
+
+
+# JPEG start-of-frame markers, which carry the image dimensions
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _jpeg_height(content: bytes):
+    """
+    Read the height of a JPEG image from its start-of-frame header.
+
+    Args:
+        content (bytes): The encoded image.
+
+    Returns:
+        int | None: The height in pixels, or None if the content is not a parsable JPEG.
+    """
+    if content[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(content):
+        if content[i] != 0xFF:
+            return None
+        marker = content[i + 1]
+        if marker == 0xFF:
+            i += 1
+        elif marker in _JPEG_SOF_MARKERS:
+            return struct.unpack_from(">H", content, i + 5)[0]
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            i += 2
+        else:
+            i += 2 + struct.unpack_from(">H", content, i + 2)[0]
+    return None
+
+
+def _create_session():
+    """
+    Create an aiohttp client session tuned for pooling connections to image CDNs.
+
+    Returns:
+        aiohttp.ClientSession: The client session.
+    """
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=16, ttl_dns_cache=300)
+    # Only time out on the socket: a total timeout would also count the time a
+    # request spends waiting for a free pooled connection
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def _load_image(content: bytes):
+    """
+    Prepare a downloaded image for embedding in a chapter PDF.
+
+    Args:
+        content (bytes): The encoded image.
+
+    Returns:
+        bytes | None: The image bytes to embed, or None if the image is too short or unreadable.
+    """
+    # JPEGs are embedded as is, so only their header needs reading
+    height = _jpeg_height(content)
+    if height is not None:
+        return content if height > 500 else None
+    try:
+        # Image.open only reads the header unless the image has to be converted
+        img = Image.open(BytesIO(content))
+        if img.size[1] > 500:
+            # img2pdf embeds PNG transparency as a soft mask but rejects alpha
+            # channels in other formats such as WebP, so those are flattened
+            if img.format != "PNG" and img.mode in ("RGBA", "LA"):
+                buffer = BytesIO()
+                img.convert("RGB").save(buffer, "JPEG", quality=95)
+                return buffer.getvalue()
+            return content
+    except UnidentifiedImageError:
+        return None
+
+
+def _save_pdf(contents: list, pdf_filename: str):
+    """
+    Save a list of images as a single PDF without re-encoding them.
+
+    Args:
+        contents (list): A list of encoded image bytes, in page order.
+        pdf_filename (str): The path of the PDF to write.
+
+    Returns:
+        None
+    """
+    images = [
+        image for image in (_load_image(c) for c in contents) if image is not None
+    ]
+    if not images:
+        return
+
+    pdf = img2pdf.convert(images, layout_fun=_PDF_LAYOUT)
+    # Write to a temporary file first so an interrupted run never leaves a
+    # partial PDF behind that would be skipped as already downloaded
+    tmp_filename = pdf_filename + ".part"
+    with open(tmp_filename, "wb") as f:
+        f.write(pdf)
+    os.replace(tmp_filename, pdf_filename)
+
 
 class WebtoonSaver:
     def __init__(
@@ -46,13 +160,13 @@ class WebtoonSaver:
         if "webtoonscan.com" in url:
             self.database = {
                 "chapter_class": "wp-manga-chapter",
-                "image_class": "wp-manga-chapter-img",
+                "image_xpath": "//img[contains(concat(' ', normalize-space(@class), ' '), ' wp-manga-chapter-img ')]/@src",
             }
         elif "manhwa18.cc" in url:
             url = url + "/"
             self.database = {
                 "chapter_class": "a-h wleft",
-                "image_class": re.compile(r"loading p\d+"),
+                "image_xpath": r"//img[re:test(@class, 'loading p\d+')]/@src",
             }
 
         self.url = url
@@ -78,79 +192,54 @@ class WebtoonSaver:
             self.chapter_end = num_chapters
 
     # Get all the chapters url for the given comic url
-    def getChapterURLs(self):
+    async def getChapterURLs(self, session: aiohttp.ClientSession):
         """
         Retrieves URLs for each chapter of the comic from the provided URL.
 
+        Args:
+            session (aiohttp.ClientSession): The aiohttp client session.
+
         Returns:
-            OrderedDict: A dictionary where keys are chapter IDs and values are chapter URLs.
+            OrderedDict: A dictionary where keys are integer chapter IDs and values are chapter URLs.
         """
-        r = requests.get(self.url)
-        soup = BeautifulSoup(r.text, "html.parser")
+        async with session.get(self.url) as r:
+            r.raise_for_status()
+            html = await r.read()
+        # Strain on the tag only: while parsing, bs4 matches the unsplit class
+        # string, so the class filter is left to findAll below
+        soup = BeautifulSoup(html, "lxml", parse_only=SoupStrainer("li"))
         self.chapter_urls = OrderedDict()
 
+        # manhwa18 links are relative to the site root, webtoonscan links are absolute
+        base_url = self.url.rsplit("/", 3)[0] if "manhwa18.cc" in self.url else ""
+        search_num = _NUM_RE.search
+
         for chapter_element in soup.findAll(
             "li", {"class": self.database["chapter_class"]}
         ):
             chapter_url = chapter_element.find("a")["href"]
-            chapter_id = re.findall(r"\d+", chapter_url)[0]
-            if "webtoonscan.com" in self.url:
-                self.chapter_urls[chapter_id] = chapter_url
-            elif "manhwa18.cc" in self.url:
-                self.chapter_urls[chapter_id] = self.url.rsplit("/", 3)[0] + chapter_url
+            chapter_id = int(search_num(chapter_url).group())
+            self.chapter_urls[chapter_id] = base_url + chapter_url
 
         # Print the chapters that weren't parsed
-        last_chapter = int(list(self.chapter_urls.keys())[0])
-        first_chapter = int(list(self.chapter_urls.keys())[-1])
-        missing_chap = last_chapter - len(self.chapter_urls.keys())
+        chapter_ids = list(self.chapter_urls.keys())
+        last_chapter = chapter_ids[0]
+        first_chapter = chapter_ids[-1]
+        missing_chap = last_chapter - len(chapter_ids)
         if missing_chap > 0:
-            expected_list = [i for i in range(first_chapter, last_chapter + 1)]
-            chapter_list = [int(i) for i in self.chapter_urls.keys()]
             print(
-                f"{missing_chap} missing chapter/s for {self.comic_name} comic on {self.url} \n{list(set(expected_list).difference(chapter_list))}"
+                f"{missing_chap} missing chapter/s for {self.comic_name} comic on {self.url} \n{sorted(set(range(first_chapter, last_chapter + 1)).difference(chapter_ids))}"
             )
 
-        if self.chapter_start:
-            self.chapter_urls = {
-                chapter_id: chapter_url
-                for chapter_id, chapter_url in self.chapter_urls.items()
-                if int(chapter_id) >= self.chapter_start
-            }
-
-        if self.chapter_end:
+        start, end = self.chapter_start, self.chapter_end
+        if start or end:
             self.chapter_urls = {
                 chapter_id: chapter_url
                 for chapter_id, chapter_url in self.chapter_urls.items()
-                if int(chapter_id) <= self.chapter_end
+                if (not start or chapter_id >= start) and (not end or chapter_id <= end)
             }
 
-    def atoi(self, text: str):
-        """
-        Convert a string of digits to an integer.
-
-        Args:
-            text (str): The string to convert.
-
-        Returns:
-            int or str: The converted integer if the input is all digits, otherwise the original string.
-        """
-        return int(text) if text.isdigit() else text
-
-    def natural_keys(self, text: str):
-        """
-        Sort key function for natural sorting.
-
-        Args:
-            text (str): The text to be sorted.
-
-        Returns:
-            list: A list containing integers and strings for natural sorting.
-        """
-        return [self.atoi(c) for c in re.split(r"(\d+)", text)]
-
-    async def download_image(
-        self, session: aiohttp.ClientSession, url: str, idx: int, image_save_path: str
-    ):
+    async def download_image(self, session: aiohttp.ClientSession, url: str, idx: int):
         """
         Download an image from the provided URL asynchronously.
 
@@ -158,113 +247,282 @@ class WebtoonSaver:
             session (aiohttp.ClientSession): The aiohttp client session.
             url (str): The URL of the image to download.
             idx (int): The index of the image in the comic.
-            image_save_path (str): The path where the downloaded image will be saved.
 
         Returns:
-            int: The index of the downloaded image.
+            tuple: The index of the image and its raw bytes.
         """
         async with session.get(url) as response:
-            content = await response.read()
-            async with aio_open(f"{image_save_path}/images{idx+1}.jpg", "wb") as f:
-                await f.write(content)
-            return idx
+            # An error page would otherwise be mistaken for the image bytes
+            response.raise_for_status()
+            return idx, await response.read()
 
-    async def download_images(self, image_urls: list, image_save_path: str):
+    async def download_images(self, session: aiohttp.ClientSession, image_urls: list):
         """
         Download multiple images asynchronously from the provided URLs.
 
         Args:
+            session (aiohttp.ClientSession): The aiohttp client session.
             image_urls (list): A list of URLs of the images to download.
-            image_save_path (str): The path where the downloaded images will be saved.
 
         Returns:
-            list: A list of integers representing the indices of the downloaded images.
+            list: A list of (index, bytes) tuples of the downloaded images, sorted by index.
         """
-        async with aiohttp.ClientSession() as session:
-            tasks = [
-                self.download_image(session, url, idx, image_save_path)
-                for idx, url in enumerate(image_urls)
-            ]
-            return await asyncio.gather(*tasks)
-
-    async def process_chapter(self, chapter_id: str, chapter_url: str, save_path: str):
+        queue = asyncio.Queue()
+        for idx, url in enumerate(image_urls):
+            queue.put_nowait((idx, url))
+
+        downloaded_images = []
+
+        async def worker():
+            while True:
+                idx, url = await queue.get()
+                try:
+                    downloaded_images.append(
+                        await self.download_image(session, url, idx)
+                    )
+                except Exception as e:
+                    # Keep the worker alive, otherwise queue.join() could wait forever
+                    print(f"Failed to download image {idx + 1} from {url}: {e!r}")
+                finally:
+                    queue.task_done()
+
+        workers = [
+            asyncio.create_task(worker())
+            for _ in range(min(IMAGE_WORKERS, len(image_urls)))
+        ]
+        await queue.join()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        return sorted(downloaded_images, key=lambda image: image[0])
+
+    async def process_chapter(
+        self,
+        session: aiohttp.ClientSession,
+        chapter_id: int,
+        chapter_url: str,
+        save_path: str,
+    ):
         """
         Process a chapter of the comic, download images, and save as a PDF.
 
         Args:
-            chapter_id (str): The ID of the chapter.
+            session (aiohttp.ClientSession): The aiohttp client session.
+            chapter_id (int): The ID of the chapter.
             chapter_url (str): The URL of the chapter.
             save_path (str): The path where the PDF will be saved.
 
         Returns:
             None
         """
-        image_save_path = save_path + f"Chapter{chapter_id}_Images/"
         pdf_filename = save_path + f"Chapter-{chapter_id}.pdf"
 
         if not os.path.isfile(pdf_filename):
-            if os.path.isdir(image_save_path):
-                rmtree(image_save_path)
-            os.mkdir(image_save_path)
-
-            r = requests.get(chapter_url)
-            soup = BeautifulSoup(r.text, "html.parser")
+            async with session.get(chapter_url) as r:
+                r.raise_for_status()
+                html = await r.read()
+            tree = lxml.html.fromstring(html)
 
-            images = soup.findAll("img", {"class": self.database["image_class"]})
-            image_urls = [re.sub("\s+", "", i["src"]) for i in images]
+            images = tree.xpath(self.database["image_xpath"], namespaces=_XPATH_NS)
+            image_urls = [src.translate(_WS_TABLE) for src in images]
 
-            downloaded_indexes = await self.download_images(image_urls, image_save_path)
+            downloaded_images = await self.download_images(session, image_urls)
 
-            if len(downloaded_indexes) != len(image_urls):
+            # Writing a PDF with missing pages would make later runs skip the chapter
+            if len(downloaded_images) != len(image_urls):
                 print(
-                    f"Total {len(downloaded_indexes)} Images Downloaded Out of {len(image_urls)} for Chapter {chapter_id}"
+                    f"Total {len(downloaded_images)} Images Downloaded Out of {len(image_urls)} for Chapter {chapter_id}, skipping PDF"
                 )
+                return
 
-            alist = os.listdir(image_save_path)
-            alist.sort(key=self.natural_keys)
-            imagelist = [image_save_path + i for i in alist if ".jpg" in i]
+            await asyncio.get_running_loop().run_in_executor(
+                PDF_EXECUTOR,
+                _save_pdf,
+                [content for _, content in downloaded_images],
+                pdf_filename,
+            )
 
-            im_list = []
+    async def _run_process_chapter(
+        self, chapter_id: int, chapter_url: str, save_path: str
+    ):
+        """
+        Process a single chapter with its own aiohttp client session.
 
-            def load_image(image_path):
-                try:
-                    img = Image.open(image_path)
-                    if img.height > 500:
-                        if img.mode == "RGBA":
-                            img = img.convert("RGB")
-                        return img
-                except UnidentifiedImageError:
-                    return None
-
-            with ThreadPoolExecutor() as executor:
-                im_list = list(executor.map(load_image, imagelist))
-
-            im_list = [img for img in im_list if img is not None]
-
-            if im_list:
-                im_list[0].save(
-                    pdf_filename,
-                    "PDF",
-                    resolution=100.0,
-                    save_all=True,
-                    append_images=im_list[1:],
-                )
+        Args:
+            chapter_id (int): The ID of the chapter.
+            chapter_url (str): The URL of the chapter.
+            save_path (str): The path where the PDF will be saved.
 
-            rmtree(image_save_path)
+        Returns:
+            None
+        """
+        async with _create_session() as session:
+            await self.process_chapter(session, chapter_id, chapter_url, save_path)
 
-    def run_process_chapter(self, chapter_id: str, chapter_url: str, save_path: str):
+    def run_process_chapter(self, chapter_id: int, chapter_url: str, save_path: str):
         """
         Asynchronously run the process of downloading and saving a chapter of the comic as a PDF.
 
         Args:
-            chapter_id (str): The ID of the chapter.
+            chapter_id (int): The ID of the chapter.
             chapter_url (str): The URL of the chapter.
             save_path (str): The path where the PDF will be saved.
 
         Returns:
             None
         """
-        asyncio.run(self.process_chapter(chapter_id, chapter_url, save_path))
+        _run(self._run_process_chapter(chapter_id, chapter_url, save_path))
+
+
+def _run_in_new_loop(coro):
+    """
+    Run a coroutine on a new event loop, using uvloop when it is installed.
+
+    Args:
+        coro (Coroutine): The coroutine to run.
+
+    Returns:
+        Any: The result of the coroutine.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(coro)
+    # Only this run uses uvloop; the process-wide event loop policy is untouched
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+        return runner.run(coro)
+
+
+def _run(coro):
+    """
+    Run a coroutine to completion, even when called from a running event loop.
+
+    Jupyter kernels already run an event loop, where asyncio.run() is not
+    allowed, so the coroutine is then run on a fresh loop in a worker thread.
+
+    Args:
+        coro (Coroutine): The coroutine to run.
+
+    Returns:
+        Any: The result of the coroutine.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return _run_in_new_loop(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_run_in_new_loop, coro).result()
+
+
+async def _bounded(sem: asyncio.Semaphore, coro):
+    """
+    Await a coroutine while holding the given semaphore.
+
+    Args:
+        sem (asyncio.Semaphore): The semaphore limiting concurrency.
+        coro (Coroutine): The coroutine to await.
+
+    Returns:
+        Any: The result of the coroutine.
+    """
+    async with sem:
+        return await coro
+
+
+async def _process_comics(comic_objs: list, concurrency: int):
+    """
+    Fetch the chapter lists of the given comics and download all their chapters on a single event loop.
+
+    Args:
+        comic_objs (list): A list of WebtoonSaver objects whose chapters are downloaded.
+        concurrency (int): The maximum number of chapters processed at once, across all comics.
+
+    Returns:
+        None
+    """
+    sem = asyncio.Semaphore(concurrency)
+    async with _create_session() as session:
+        results = await asyncio.gather(
+            *[comic_obj.getChapterURLs(session) for comic_obj in comic_objs],
+            return_exceptions=True,
+        )
+        # Continue with the comics whose chapter list could be fetched
+        for comic_obj, result in zip(comic_objs, results):
+            if isinstance(result, Exception):
+                print(
+                    f"Failed to get chapters for {comic_obj.comic_name} comic on {comic_obj.url}: {result!r}"
+                )
+        comic_objs = [
+            comic_obj
+            for comic_obj, result in zip(comic_objs, results)
+            if not isinstance(result, Exception)
+        ]
+
+        chapters = [
+            (comic_obj, chapter_id, chapter_url)
+            for comic_obj in comic_objs
+            for chapter_id, chapter_url in comic_obj.chapter_urls.items()
+        ]
+        results = await asyncio.gather(
+            *[
+                _bounded(
+                    sem,
+                    comic_obj.process_chapter(
+                        session, chapter_id, chapter_url, comic_obj.save_path
+                    ),
+                )
+                for comic_obj, chapter_id, chapter_url in chapters
+            ],
+            return_exceptions=True,
+        )
+
+    # A failed chapter must not cancel the others, so failures are reported here
+    for (comic_obj, chapter_id, _), result in zip(chapters, results):
+        if isinstance(result, Exception):
+            print(
+                f"Chapter {chapter_id} of {comic_obj.comic_name} failed: {result!r}"
+            )
+
+
+def run_webtoonsaver_batch(
+    urls: list,
+    num_chapters: int | None = None,
+    chapter_range: dict | None = {"start": None, "end": None},
+    n_workers: int = -1,
+):
+    """
+    Download and save chapters of several comics, sharing one event loop and connection pool.
+
+    Args:
+        urls (list): A list of comic URLs.
+        num_chapters (int, optional): The number of chapters to download per comic. Overrides chapter_range if provided.
+        chapter_range (dict, optional): A dictionary with 'start' and 'end' keys to specify the range of chapters to download for every comic. Defaults to {"start": None, "end": None}.
+        n_workers (int, optional): The number of chapters downloaded concurrently. Defaults to -1, which sets the number of workers to the number of available CPU cores.
+
+    Returns:
+        None
+    """
+    comic_objs = []
+    for url in urls:
+        try:
+            comic_objs.append(
+                WebtoonSaver(
+                    url=url, num_chapters=num_chapters, chapter_range=chapter_range
+                )
+            )
+        except Exception as e:
+            print(f"Skipping comic on {url}: {e!r}")
+
+    if n_workers == -1:
+        n_workers = os.cpu_count()
+    else:
+        if n_workers > os.cpu_count():
+            n_workers = os.cpu_count()
+
+    # Each chapter keeps its images in memory until it is saved, so only as
+    # many chapters as workers are in flight
+    _run(_process_comics(comic_objs, n_workers))
 
 
 def run_webtoonsaver(
@@ -280,27 +538,14 @@ def run_webtoonsaver(
         url (str): The URL of the comic.
         num_chapters (int, optional): The number of chapters to download. Overrides chapter_range if provided.
         chapter_range (dict, optional): A dictionary with 'start' and 'end' keys to specify the range of chapters to download. Defaults to {"start": None, "end": None}.
-        n_workers (int, optional): The number of worker processes to use. Defaults to -1, which sets the number of workers to the number of available CPU cores.
+        n_workers (int, optional): The number of chapters downloaded concurrently. Defaults to -1, which sets the number of workers to the number of available CPU cores.
 
     Returns:
         None
     """
-    comic_obj = WebtoonSaver(
-        url=url, num_chapters=num_chapters, chapter_range=chapter_range
+    run_webtoonsaver_batch(
+        [url],
+        num_chapters=num_chapters,
+        chapter_range=chapter_range,
+        n_workers=n_workers,
     )
-    comic_obj.getChapterURLs()
-    chapter_urls = list(comic_obj.chapter_urls.items())
-
-    tasks = [
-        (chapter_id, chapter_url, comic_obj.save_path)
-        for chapter_id, chapter_url in chapter_urls
-    ]
-
-    if n_workers == -1:
-        n_workers = mp.cpu_count()
-    else:
-        if n_workers > mp.cpu_count():
-            n_workers = mp.cpu_count()
-
-    with mp.Pool(n_workers) as p:
-        p.starmap(comic_obj.run_process_chapter, tasks)